@@ -1,25 +1,28 @@
-from PIL import Image
-from sklearn.metrics import classification_report
 from AnalysisToolkit import AnalysisToolkit
-from pyprobar import probar
-import cv2
+from RFF import RFF
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torchvision import datasets, transforms
 from torch.utils.data import SubsetRandomSampler
 from torch.utils.data import DataLoader
-from sklearn.model_selection import train_test_split
-import wandb
+from torch.utils.data import Dataset
+import copy
+import datetime
+import hashlib
+import itertools
+import json
+import multiprocessing
 import os
 import random
+import time
 
 class ANN(AnalysisToolkit):
-    def __init__(self, route, vis_deg, rot_deg, ANN_flag, train_path, test_path):
-        AnalysisToolkit.__init__(self, route, vis_deg, rot_deg)
+    HYPERPARAMETER_NAMES = ["TRAIN_VAL_SPLIT", "EPOCHS", "BATCH_SIZE", "LEARNING_RATE", "PATIENCE", "CHECKPOINT_INTERVAL"]
+
+    def __init__(self, route, vis_deg, rot_deg, ANN_flag, train_path=None, test_path=None, hyperparameters=None,
+                 resolution=(45, 8)):
+        AnalysisToolkit.__init__(self, route, vis_deg, rot_deg, resolution)
 
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         print(f"RUNNING ON: {self.device}")
@@ -28,12 +31,18 @@ class ANN(AnalysisToolkit):
         np.random.seed(101)
         random.seed(101)
 
-        # ANN hyper-parameters
-        self.INPUT_SIZE = 360
+        # ANN hyper-parameters, overridden by name (in any case) from hyperparameters. INPUT_SIZE follows the resolution
+        self.INPUT_SIZE = self.resolution[0] * self.resolution[1]
         self.TRAIN_VAL_SPLIT = 0.4
         self.EPOCHS = 50
         self.BATCH_SIZE = 32
         self.LEARNING_RATE = 0.001
+        self.PATIENCE = None
+        self.CHECKPOINT_INTERVAL = 1
+        for name, value in (hyperparameters or {}).items():
+            if name.upper() not in self.HYPERPARAMETER_NAMES:
+                raise ValueError(f"Unknown hyperparameter {name}, expected one of {', '.join(self.HYPERPARAMETER_NAMES)}")
+            setattr(self, name.upper(), value)
 
         if ANN_flag == 'MLP':
             self.model_name = 'MLP'
@@ -42,63 +51,104 @@ class ANN(AnalysisToolkit):
             self.model_name = 'RBFNN'
             self.model_class = RBFNNModel(self.INPUT_SIZE)
 
-        # Preprocess transforms
-        self.transform = transforms.Compose([transforms.Grayscale(num_output_channels=1), transforms.ToTensor()])
-
-        # Data loading
-        dataloaders = self.get_dataloaders(train_path, test_path)
-        self.trainloader = dataloaders['TRAIN']
-        self.valloader = dataloaders['VAL']
-        self.testloader = dataloaders['TEST']
+        # Data loading, skipped in inference mode when no training data is given
+        self.train_path = train_path
+        self.trainloader, self.valloader, self.testloader = None, None, None
+        if train_path is not None:
+            dataloaders = self.get_dataloaders(train_path, test_path)
+            self.trainloader = dataloaders['TRAIN']
+            self.valloader = dataloaders['VAL']
+            self.testloader = dataloaders['TEST']
 
         # Arbitrary initialization
         self.model = None
+        self.inference_model = None
+        # What the inference model is, part of the latent space cache key, and the model file latent spaces are cached for
+        self.inference_mode = "FLOAT"
+        self.latent_space_cache_model_path = None
         self.route_view_layton_spaces = None
 
-    def gen_data(self, angle, is_random=False, split=0.2):
+    # Models take views of one resolution, so the model class is recreated for the new input size and any loaded model,
+    # inference model and route view latent spaces are dropped. Load or train a model at the new resolution after this
+    def set_resolution(self, resolution):
+        AnalysisToolkit.set_resolution(self, resolution)
+        self.INPUT_SIZE = self.resolution[0] * self.resolution[1]
+        self.model_class = type(self.model_class)(self.INPUT_SIZE)
+        self.model = None
+        self.inference_model = None
+        self.inference_mode = "FLOAT"
+        for route in self.route_names:
+            with self.selected_route(route):
+                self.set_route_state(route_view_layton_spaces=None)
+
+    # Limit each database analysis worker to one thread so workers don't oversubscribe the CPU cores
+    def init_worker(self):
+        torch.set_num_threads(1)
+
+    # Training examples of the route views, split into TRAIN and TEST datasets. Negatives are the route views rotated by
+    # +-angle or, if is_random, randomly rotated off-route views drawn from the whole grid, or from a random sample of
+    # n_off_route grid views, generated on the fly. TEST negatives are the same on every access
+    def gen_datasets(self, angle, is_random=False, split=0.2, n_off_route=None):
+        route_views = self.load_route_views()
+        if is_random:
+            if self.grid_views is None:
+                self.load_grid_view_cache()
+            off_route_views = self.grid_views
+            if n_off_route is not None:
+                off_route_views = off_route_views[np.sort(np.random.choice(len(off_route_views), n_off_route, replace=False))]
+        else:
+            off_route_views = None
+        from sklearn.model_selection import train_test_split
+        train, test = train_test_split(np.arange(len(route_views) * (2 if is_random else 3)), test_size=split)
+        return {"TRAIN": ViewDataset(route_views, train, angle, self.vis_deg, off_route_views),
+                "TEST": ViewDataset(route_views, test, angle, self.vis_deg, off_route_views, fixed_negatives=True)}
+
+    # Saves the training examples of gen_datasets as a single compressed shard, named with the resolution, of the
+    # preprocessed route views, the off-route views negatives are drawn from and the TRAIN and TEST example indexes
+    def gen_data(self, angle, is_random=False, split=0.2, n_off_route=None):
         print('Generating data...')
-        dp = []
-        for on_route_filename in probar(self.route_filenames):
-            if is_random:
-                off_route_filename = self.grid_filenames[(random.choice(self.grid_X)), random.choice(self.grid_Y)]
-                on_route_view = self.preprocess(cv2.imread(self.route_path + on_route_filename))
-                off_route_view = self.preprocess(cv2.imread(self.grid_path + off_route_filename))
-                dp.append([f'{on_route_filename.strip(".png")}_0', on_route_view, 1])
-                angle = random.randint(0, 360)
-                dp.append([f'{off_route_filename.strip(".png")}_{angle}', self.rotate(off_route_view, angle), 0])
-            else:
-                view = self.preprocess(cv2.imread(self.route_path + on_route_filename))
-                dp.append([f'{on_route_filename.strip(".png")}_0', view, 1])
-                dp.append([f'{on_route_filename.strip(".png")}_{angle}', self.rotate(view, angle), 0])
-                dp.append([f'{on_route_filename.strip(".png")}_-{angle}', self.rotate(view, -angle), 0])
-        df = pd.DataFrame(dp, columns=['FILENAME', 'VIEW', 'LABEL'])
-        train, test = train_test_split(df, test_size=split)
-        for dataset in ["TRAIN", "TEST"]:
-            for label in ["0", "1"]:
-                if is_random:
-                    path = f"ANN_DATA/{self.route_name}/RAND_DATA/{dataset}/{label}"
-                else:
-                    path = f"./ANN_DATA/{self.route_name}/{angle}_DEGREES_DATA/{dataset}/{label}"
-                if not os.path.isdir(path):
-                    os.makedirs(path)
-        for filename, view, label in train.values:
-            if random:
-                plt.imsave(f"./ANN_DATA/{self.route_name}/RAND_DATA/TRAIN/{label}/{filename}.png",
-                           cv2.cvtColor(view.astype(np.uint8), cv2.COLOR_BGR2RGB))
-            else:
-                plt.imsave(f"./ANN_DATA/{self.route_name}/{angle}_DEGREES_DATA/TRAIN/{label}/{filename}.png",
-                           cv2.cvtColor(view.astype(np.uint8), cv2.COLOR_BGR2RGB))
-        for filename, view, label in test.values:
-            if random:
-                plt.imsave(f"./ANN_DATA/{self.route_name}/RAND_DATA/TEST/{label}/{filename}.png",
-                           cv2.cvtColor(view.astype(np.uint8), cv2.COLOR_BGR2RGB))
-            else:
-                plt.imsave(f"./ANN_DATA/{self.route_name}/{angle}_DEGREES_DATA/TEST/{label}/{filename}.png",
-                           cv2.cvtColor(view.astype(np.uint8), cv2.COLOR_BGR2RGB))
-
+        view_datasets = self.gen_datasets(angle, is_random, split, n_off_route)
+        route_views = view_datasets["TRAIN"].route_views
+        if is_random:
+            off_route_views = np.asarray(view_datasets["TRAIN"].off_route_views)
+            path = f"ANN_DATA/{self.route_name}/RAND_DATA_{self.resolution[0]}x{self.resolution[1]}.npz"
+        else:
+            off_route_views = np.empty((0,) + route_views.shape[1:], dtype=np.uint8)
+            path = f"ANN_DATA/{self.route_name}/{angle}_DEGREES_DATA_{self.resolution[0]}x{self.resolution[1]}.npz"
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        np.savez_compressed(path, ROUTE_VIEWS=route_views, OFF_ROUTE_VIEWS=off_route_views, ANGLE=angle,
+                            IS_RANDOM=is_random, TRAIN=view_datasets["TRAIN"].example_idxs, TEST=view_datasets["TEST"].example_idxs)
+        return path
+
+    # Dataset of one split of a shard saved by gen_data, which must hold views at the current resolution
+    def load_dataset(self, path, split):
+        shard = np.load(path)
+        if shard["ROUTE_VIEWS"].shape[1:] != self.resolution[::-1]:
+            raise ValueError(f"{path} holds views preprocessed to {shard['ROUTE_VIEWS'].shape[2]}x{shard['ROUTE_VIEWS'].shape[1]}, "
+                             f"not {self.resolution[0]}x{self.resolution[1]}")
+        off_route_views = shard["OFF_ROUTE_VIEWS"] if shard["IS_RANDOM"] else None
+        return ViewDataset(shard["ROUTE_VIEWS"], shard[split], int(shard["ANGLE"]), self.vis_deg, off_route_views,
+                           fixed_negatives=split == "TEST")
+
+    # Dataloaders of a shard saved by gen_data, or of TRAIN and TEST image folders
     def get_dataloaders(self, train_path, test_path):
-        train_dataset = datasets.ImageFolder(train_path, transform=self.transform)
-        test_dataset = datasets.ImageFolder(test_path, transform=self.transform)
+        if train_path.endswith(".npz"):
+            return self.get_dataset_dataloaders(self.load_dataset(train_path, "TRAIN"), self.load_dataset(test_path, "TEST"))
+        from torchvision import datasets, transforms
+        transform = transforms.Compose([transforms.Grayscale(num_output_channels=1), transforms.ToTensor()])
+        return self.get_dataset_dataloaders(datasets.ImageFolder(train_path, transform=transform),
+                                            datasets.ImageFolder(test_path, transform=transform))
+
+    # Trains and tests on datasets from gen_datasets without writing them to disk
+    def set_datasets(self, view_datasets):
+        self.train_path = None
+        dataloaders = self.get_dataset_dataloaders(view_datasets["TRAIN"], view_datasets["TEST"])
+        self.trainloader = dataloaders['TRAIN']
+        self.valloader = dataloaders['VAL']
+        self.testloader = dataloaders['TEST']
+
+    def get_dataset_dataloaders(self, train_dataset, test_dataset):
         train_dataset_indices = list(range(len(train_dataset)))
         np.random.shuffle(train_dataset_indices)
         train_sampler = SubsetRandomSampler(train_dataset_indices[int(np.floor(self.TRAIN_VAL_SPLIT * len(train_dataset))):])
@@ -112,27 +162,65 @@ class ANN(AnalysisToolkit):
         correct_pred = (y_pred_tags == y_test).float()
         return torch.round(correct_pred.sum() / len(correct_pred)*100)
 
-    def train_model(self, save_path="ANN_MODELS", save_model=True):
+    # Trains the model, logging to W&B if use_wandb (wandb_mode="offline" logs without a connection), and saves its
+    # weights, metrics and training time as <run_name>.pth and <run_name>.json. Returns the metrics. With a PATIENCE,
+    # training stops once the validation loss hasn't improved for that many epochs and keeps the best weights. Model
+    # and optimiser state are checkpointed every CHECKPOINT_INTERVAL epochs with the torch, NumPy and Python RNG states,
+    # and resume continues a named run from its last checkpoint, or loads it if it has already finished
+    def train_model(self, save_path="ANN_MODELS", save_model=True, use_wandb=True, wandb_mode=None, run_name=None,
+                    resume=False):
         model = self.model_class
         model.to(self.device)
 
         loss_func = nn.CrossEntropyLoss()
         optimizer = optim.Adam(params=model.parameters(), lr=self.LEARNING_RATE)
 
-        if save_model:
+        use_wandb = use_wandb and save_model
+        if use_wandb:
+            import wandb
             if self.model_name == "MLP":
-                wandb.init(project='routenavigation-mlp')
+                wandb.init(project='routenavigation-mlp', name=run_name, mode=wandb_mode)
             if self.model_name == 'RBFNN':
-                wandb.init(project='routenavigation-rbfnn')
+                wandb.init(project='routenavigation-rbfnn', name=run_name, mode=wandb_mode)
             wandb.watch(model)
+            run_name = wandb.run.name
+        if run_name is None:
+            run_name = f"{self.model_name}_{datetime.datetime.now().strftime('%d-%m-%Y_%H-%M-%S')}"
+        checkpoint_path = f"{save_path}/{run_name}_checkpoint.pt"
+
+        run_config = self.get_run_config()
+        if resume and os.path.isfile(f"{save_path}/{run_name}.pth") and os.path.isfile(f"{save_path}/{run_name}.json"):
+            with open(f"{save_path}/{run_name}.json") as jsonfile:
+                stats = json.load(jsonfile)
+            self.check_run_config(f"{save_path}/{run_name}.json", {name: stats.get(name) for name in run_config})
+            print(f"{run_name} has already finished training")
+            model.load_state_dict(torch.load(f"{save_path}/{run_name}.pth", map_location=self.device))
+            if use_wandb:
+                wandb.finish()
+            return stats
 
         accuracy_stats = {'train': [], 'val': []}
         loss_stats = {'train': [], 'val': []}
+        start_epoch, best_epoch, best_val_loss, best_state, train_time = 0, 0, float('inf'), None, 0
+        if resume and os.path.isfile(checkpoint_path):
+            checkpoint = torch.load(checkpoint_path, map_location=self.device)
+            self.check_run_config(checkpoint_path, checkpoint.get('CONFIG', {}))
+            model.load_state_dict(checkpoint['MODEL'])
+            optimizer.load_state_dict(checkpoint['OPTIMIZER'])
+            start_epoch, best_epoch, best_val_loss = checkpoint['EPOCH'] + 1, checkpoint['BEST_EPOCH'], checkpoint['BEST_VAL_LOSS']
+            best_state, train_time = checkpoint['BEST_MODEL'], checkpoint['TRAIN_TIME']
+            loss_stats, accuracy_stats = checkpoint['LOSS'], checkpoint['ACCURACY']
+            torch.set_rng_state(checkpoint['RNG_STATE'].cpu())
+            np_rng_state = checkpoint['NP_RNG_STATE']
+            np.random.set_state((np_rng_state[0], np.array(np_rng_state[1], dtype=np.uint32)) + tuple(np_rng_state[2:]))
+            random.setstate(checkpoint['PY_RNG_STATE'])
+            print(f"Resuming from epoch {start_epoch + 1:02}")
 
         print("Beginning training")
-        for epoch in range(self.EPOCHS):
+        start_time = time.perf_counter() - train_time
+        for epoch in range(start_epoch, self.EPOCHS):
             model.train()
-            train_epoch_loss, train_epoch_acc = 0, 0
+            train_epoch_loss, train_epoch_acc = torch.zeros((), device=self.device), torch.zeros((), device=self.device)
             for X_train_batch, y_train_batch in self.trainloader:
                 X_train_batch, y_train_batch = X_train_batch.to(self.device), y_train_batch.to(self.device)
                 optimizer.zero_grad()
@@ -146,11 +234,11 @@ class ANN(AnalysisToolkit):
                 train_loss.backward()
                 optimizer.step()
 
-                train_epoch_loss += train_loss.item()
-                train_epoch_acc += train_acc.item()
+                train_epoch_loss += train_loss.detach()
+                train_epoch_acc += train_acc
             with torch.no_grad():
                 model.eval()
-                val_epoch_loss, val_epoch_acc = 0, 0
+                val_epoch_loss, val_epoch_acc = torch.zeros((), device=self.device), torch.zeros((), device=self.device)
                 for X_val_batch, y_val_batch in self.valloader:
                     X_val_batch, y_val_batch = X_val_batch.to(self.device), y_val_batch.to(self.device)
 
@@ -159,9 +247,12 @@ class ANN(AnalysisToolkit):
                     val_loss = loss_func(y_val_pred, y_val_batch)
                     val_acc = self.multi_acc(y_val_pred, y_val_batch)
 
-                    val_epoch_loss += val_loss.item()
-                    val_epoch_acc += val_acc.item()
+                    val_epoch_loss += val_loss
+                    val_epoch_acc += val_acc
 
+            # A single device sync per epoch
+            train_epoch_loss, train_epoch_acc, val_epoch_loss, val_epoch_acc = torch.stack(
+                [train_epoch_loss, train_epoch_acc, val_epoch_loss, val_epoch_acc]).tolist()
             loss_stats['train'].append(train_epoch_loss / len(self.trainloader))
             loss_stats['val'].append(val_epoch_loss / len(self.valloader))
             accuracy_stats['train'].append(train_epoch_acc / len(self.trainloader))
@@ -169,26 +260,168 @@ class ANN(AnalysisToolkit):
 
             print(f"Epoch {(epoch+1)+0:02}: | Train Loss: {loss_stats['train'][-1]:.5f} | Val Loss: {loss_stats['val'][-1]:.5f} | "
                   f"Train Acc: {accuracy_stats['train'][-1]:.3f} | Val Acc: {accuracy_stats['val'][-1]:.3f}")
-            if save_model:
+            if use_wandb:
                 wandb.log({'Train Loss': loss_stats['train'][-1], 'Val Loss': loss_stats['val'][-1],
                            'Train Acc': accuracy_stats['train'][-1], 'Val Acc': accuracy_stats['val'][-1]})
+
+            if loss_stats['val'][-1] < best_val_loss:
+                best_epoch, best_val_loss = epoch, loss_stats['val'][-1]
+                best_state = copy.deepcopy(model.state_dict())
+            stop = self.PATIENCE is not None and epoch - best_epoch >= self.PATIENCE
+            if save_model and ((epoch + 1) % self.CHECKPOINT_INTERVAL == 0 or stop):
+                if not os.path.isdir(save_path):
+                    os.makedirs(save_path)
+                torch.save({'EPOCH': epoch, 'MODEL': model.state_dict(), 'OPTIMIZER': optimizer.state_dict(),
+                            'BEST_EPOCH': best_epoch, 'BEST_VAL_LOSS': best_val_loss, 'BEST_MODEL': best_state,
+                            'TRAIN_TIME': time.perf_counter() - start_time, 'LOSS': loss_stats, 'ACCURACY': accuracy_stats,
+                            'RNG_STATE': torch.get_rng_state(), 'NP_RNG_STATE': self.get_np_rng_state(),
+                            'PY_RNG_STATE': random.getstate(), 'CONFIG': run_config}, checkpoint_path + ".tmp")
+                os.replace(checkpoint_path + ".tmp", checkpoint_path)
+            if stop:
+                print(f"Stopping early, validation loss hasn't improved since epoch {best_epoch + 1:02}")
+                break
+        train_time = time.perf_counter() - start_time
+        if self.PATIENCE is not None and best_state is not None:
+            model.load_state_dict(best_state)
         print("Finished Training")
+        stats = {'RUN_NAME': run_name, 'MODEL': self.model_name, 'EPOCHS': len(loss_stats['train']),
+                 'BEST_EPOCH': best_epoch + 1, 'BATCH_SIZE': self.BATCH_SIZE, 'LEARNING_RATE': self.LEARNING_RATE,
+                 'TRAIN_TIME': train_time, 'LOSS': loss_stats, 'ACCURACY': accuracy_stats, **run_config}
         if save_model:
             if not os.path.isdir(save_path):
                 os.makedirs(save_path)
-            torch.save(model.state_dict(), f"{save_path}/{wandb.run.name}.pth")
-
-    def load_model(self, model_path):
+            torch.save(model.state_dict(), f"{save_path}/{run_name}.pth")
+            with open(f"{save_path}/{run_name}.json", 'w') as jsonfile:
+                json.dump(stats, jsonfile, indent=4)
+            if os.path.isfile(checkpoint_path):
+                os.remove(checkpoint_path)
+        if use_wandb:
+            wandb.finish()
+        return stats
+
+    # Training data, view parameters and hyperparameters of a run, recorded with its checkpoints and results
+    def get_run_config(self):
+        return {'DATA': self.train_path, 'RESOLUTION': list(self.resolution), 'VIS_DEG': self.vis_deg,
+                'ROT_DEG': self.rot_deg, 'HYPERPARAMETERS': {name: getattr(self, name) for name in self.HYPERPARAMETER_NAMES}}
+
+    # Raises if a checkpoint or finished run was saved with another run config, rather than resuming or returning it
+    def check_run_config(self, path, run_config):
+        mismatched = [name for name, value in self.get_run_config().items() if run_config.get(name) != value]
+        if len(mismatched) > 0:
+            raise ValueError(f"{path} was saved with a different {', '.join(mismatched)}; use another run name or save path")
+
+    # NumPy's global RNG state as plain Python values, which torch.load restores without unpickling arrays
+    def get_np_rng_state(self):
+        name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+        return (name, keys.tolist(), int(pos), int(has_gauss), float(cached_gaussian))
+
+    def load_model(self, model_path, cache_latent_spaces=False):
         print("Loading model...")
         model = self.model_class
         model.to(self.device)
-        model.load_state_dict(torch.load(model_path))
+        model.load_state_dict(torch.load(model_path, map_location=self.device))
         self.model = model
+        self.latent_space_cache_model_path = model_path if cache_latent_spaces else None
+        self.load_route_view_latent_spaces()
+
+    # Route view latent spaces of every route from the model queries run through, recalculated whenever the model or
+    # inference model changes so that query and route view latent spaces come from the same embedding
+    def load_route_view_latent_spaces(self):
+        if self.model is None:
+            return
+        for route in self.route_names:
+            with self.selected_route(route):
+                if self.latent_space_cache_model_path is not None:
+                    self.set_route_state(route_view_layton_spaces=self.load_route_view_latent_space_cache(self.latent_space_cache_model_path))
+                else:
+                    self.set_route_state(route_view_layton_spaces=self.get_route_view_latent_spaces())
+
+    # Latent spaces of every route view from a single forward pass, (n_route_views, latent_dim)
+    def get_route_view_latent_spaces(self):
         print("Calculating training route view latent spaces...")
-        self.route_view_layton_spaces = []
-        for filename in probar(self.route_filenames):
-            self.model(self.transform(Image.fromarray(self.preprocess(cv2.imread(self.route_path + filename)))).float().to(self.device).view(1, self.INPUT_SIZE))
-            self.route_view_layton_spaces.append(self.model.get_latent_space())
+        with torch.no_grad():
+            return self.run_model(self.get_view_tensor(self.load_route_views()).view(-1, self.INPUT_SIZE))[1]
+
+    # Route view latent spaces cached next to the model file, recalculated when the model weights, inference mode or
+    # route views change
+    def load_route_view_latent_space_cache(self, model_path):
+        key = hashlib.sha1(f"{self.route_name}_{self.resolution[0]}x{self.resolution[1]}_{self.inference_mode}".encode())
+        with open(model_path, 'rb') as model_file:
+            key.update(model_file.read())
+        self.update_database_key(key, self.route_path, self.route_filenames)
+        cache_path = f"{os.path.splitext(model_path)[0]}_{self.route_name}_latent_spaces.pt"
+        if os.path.isfile(cache_path):
+            cache = torch.load(cache_path, map_location=self.device)
+            if cache["KEY"] == key.hexdigest():
+                return cache["LATENT_SPACES"]
+        latent_spaces = self.get_route_view_latent_spaces()
+        torch.save({"KEY": key.hexdigest(), "LATENT_SPACES": latent_spaces.cpu()}, cache_path)
+        return latent_spaces
+
+    # TorchScript graph of the trained model for CPU inference, returning its logits and latent spaces from one call.
+    # The graph is frozen, and its linear layers dynamically quantised to int8 if quantize. Saved to save_path if given
+    def build_inference_model(self, quantize=False, save_path=None):
+        if self.model is None:
+            raise ValueError("No model is loaded to build an inference model from; call load_model first")
+        model = InferenceModel(copy.deepcopy(self.model).cpu()).eval()
+        if quantize:
+            model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+        with torch.no_grad():
+            self.inference_model = torch.jit.freeze(torch.jit.trace(model, torch.zeros(2, self.INPUT_SIZE)))
+        if save_path is not None:
+            torch.jit.save(self.inference_model, save_path)
+        self.inference_mode = "TORCHSCRIPT_INT8" if quantize else "TORCHSCRIPT_FLOAT"
+        self.load_route_view_latent_spaces()
+        return self.inference_model
+
+    # Loads a saved inference model, keying cached latent spaces on the contents of its file
+    def load_inference_model(self, model_path):
+        self.inference_model = torch.jit.load(model_path, map_location='cpu')
+        with open(model_path, 'rb') as model_file:
+            self.inference_mode = f"TORCHSCRIPT_{hashlib.sha1(model_file.read()).hexdigest()}"
+        self.load_route_view_latent_spaces()
+
+    # Runs queries through the float model again
+    def unload_inference_model(self):
+        self.inference_model = None
+        self.inference_mode = "FLOAT"
+        self.load_route_view_latent_spaces()
+
+    # Logits and latent spaces of a batch of input tensors, from the inference model if one is built or loaded
+    def run_model(self, tensor):
+        if self.inference_model is None:
+            return self.model(tensor), self.model.get_latent_space()
+        logits, latent_spaces = self.inference_model(tensor.view(tensor.size(0), -1).cpu())
+        return logits.to(self.device), latent_spaces.to(self.device)
+
+    # TEST split accuracies of the float and inference models, how often their predictions agree, the largest absolute
+    # latent space difference and the time each takes over the whole split. The TEST split is the test dataloader's, or
+    # dataset's if given, e.g. the TEST dataset of gen_datasets in inference mode
+    def compare_inference_model(self, dataset=None):
+        if self.model is None or self.inference_model is None:
+            raise ValueError("Comparing needs both a loaded model and a built or loaded inference model")
+        if dataset is not None:
+            testloader = DataLoader(dataset, batch_size=self.BATCH_SIZE)
+        elif self.testloader is not None:
+            testloader = self.testloader
+        else:
+            raise ValueError("No TEST split to compare on; pass a dataset or give the ANN training data")
+        X_test, y_test = map(torch.cat, zip(*testloader))
+        X_test = X_test.view(X_test.size(0), -1).to(self.device)
+        with torch.no_grad():
+            start_time = time.perf_counter()
+            float_logits = self.model(X_test)
+            float_latent_spaces = self.model.get_latent_space()
+            float_time = time.perf_counter() - start_time
+            start_time = time.perf_counter()
+            inference_logits, inference_latent_spaces = self.inference_model(X_test.cpu())
+            inference_time = time.perf_counter() - start_time
+        float_pred, inference_pred = float_logits.argmax(dim=1).cpu(), inference_logits.argmax(dim=1)
+        return {"FLOAT_ACCURACY": (float_pred == y_test).float().mean().item() * 100,
+                "INFERENCE_ACCURACY": (inference_pred == y_test).float().mean().item() * 100,
+                "AGREEMENT": (float_pred == inference_pred).float().mean().item() * 100,
+                "MAX_LATENT_SPACE_ERROR": (float_latent_spaces.cpu() - inference_latent_spaces).abs().max().item(),
+                "FLOAT_TIME": float_time, "INFERENCE_TIME": inference_time}
 
     def test_model(self):
         y_pred, y_ground_truth = [], []
@@ -196,57 +429,195 @@ class ANN(AnalysisToolkit):
             for X_test_batch, y_test_batch in self.testloader:
                 X_test_batch, y_test_batch = X_test_batch.to(self.device), y_test_batch.to(self.device)
 
-                y_test_pred = self.model(X_test_batch)
+                y_test_pred, _ = self.run_model(X_test_batch)
                 # print(y_test_pred)
                 _, y_pred_tag = torch.max(y_test_pred, dim=1)
 
                 y_pred.append(y_pred_tag.cpu().numpy())
                 y_ground_truth.append(y_test_batch.cpu().numpy())
+        from sklearn.metrics import classification_report
         print(classification_report(y_ground_truth, y_pred, zero_division=0))
 
+    # Normalised float tensor of a batch of raw or preprocessed views, equal to the image folder transform, (n_views, H, W)
+    def get_view_tensor(self, views):
+        return self.to_tensor(np.array([self.preprocess(view) for view in views]))
+
+    # Normalised float tensor of an array of preprocessed views of any shape
+    def to_tensor(self, views_preprocessed):
+        return torch.from_numpy(np.ascontiguousarray(views_preprocessed, dtype=np.uint8)).to(self.device).float().div(255)
+
+    # Positive tag log-probabilities and latent spaces of every rotation of a batch of preprocessed views from a single
+    # forward pass, (n_views, n_rotations) and (n_views, n_rotations, latent_dim)
+    def get_rotation_scores(self, views_preprocessed):
+        width = views_preprocessed.shape[2]
+        rotations = self.get_rotation_bank(views_preprocessed)[:, self.get_rotation_shifts(width, self.rotation_angles) % width]
+        tensor = self.to_tensor(rotations).view(-1, self.INPUT_SIZE)
+        with torch.no_grad():
+            logits, latent_spaces = self.run_model(tensor)
+            pos_tag_vals = torch.log_softmax(logits, dim=1)[:, 1]
+        return (pos_tag_vals.view(len(views_preprocessed), len(self.rotation_angles)).cpu().numpy(),
+                latent_spaces.view(len(views_preprocessed), len(self.rotation_angles), -1))
+
     # Rotational Familiarity Function of a view against an ANN route representation
     def get_route_rFF(self, view, view_heading=0):
-        view_preprocessed = self.preprocess(view)
-        rFF = {}
-        for i in np.arange(0, self.vis_deg, step=self.rot_deg, dtype=int):
-            view = self.rotate(view_preprocessed, i)
-            tensor = self.transform(Image.fromarray(view)).float().to(self.device).view(1, self.INPUT_SIZE)
-            pos_tag_val = torch.index_select(torch.log_softmax(self.model(tensor), dim=1), dim=1,
-                                             index=torch.tensor([1]).to(self.device))
-            rFF[(i + view_heading) % self.vis_deg] = pos_tag_val.item()
-        return rFF
+        pos_tag_vals, _ = self.get_rotation_scores(np.array([self.preprocess(view)]))
+        return RFF((self.rotation_angles + view_heading) % self.vis_deg, pos_tag_vals[0])
+
+    # Rotational Familiarity Functions of a batch of views against an ANN route representation, one row per view
+    def get_route_rFF_batch(self, views):
+        pos_tag_vals, _ = self.get_rotation_scores(np.array([self.preprocess(view) for view in views]))
+        return RFF(self.rotation_angles, pos_tag_vals)
 
     # Need to implement this properly - placeholder
     def get_view_rFF(self, view_1, view_2, view_1_heading=0):
-        view_preprocessed = self.preprocess(view_1)
-        rFF = {}
-        for i in np.arange(0, self.vis_deg, step=self.rot_deg, dtype=int):
-            view = self.rotate(view_preprocessed, i)
-            tensor = self.transform(Image.fromarray(view)).float().to(self.device).view(1, self.INPUT_SIZE)
-            pos_tag_val = torch.index_select(torch.log_softmax(self.model(tensor), dim=1), dim=1,
-                                             index=torch.tensor([1]).to(self.device))
-            rFF[(i + view_1_heading) % self.vis_deg] = pos_tag_val.item()
-        return rFF
-
-    # Get the most familiar heading given an rFF for a view
+        pos_tag_vals, _ = self.get_rotation_scores(np.array([self.preprocess(view_1)]))
+        return RFF((self.rotation_angles + view_1_heading) % self.vis_deg, pos_tag_vals[0])
+
+    # Get the most familiar heading given an rFF for a view, or for each row of a batch of rFFs
     def get_most_familiar_heading(self, rFF):
         # return max(rFF, key=rFF.get)
         # x = [k for k, v in rFF.items() if 0.8*max(rFF.values()) <= v <= 1.2*max(rFF.values())]
-        x = [k for k, v in rFF.items() if self.is_within_prcnt(v, max(rFF.values()), 1.0)]
-        return np.median(x).astype(np.int64)
+        return rFF.median_of_maxima(1.0)
 
     # Calculates the signal strength of an rFF
     def get_signal_strength(self, rFF):
-        return max(rFF.values()) / np.array(list(rFF.values())).mean()
+        return rFF.signal_strength()
+
+    # rFF, most familiar heading and best matched route view index of a view, computed together
+    def query_route(self, view, route=None):
+        rFFs, familiar_headings, matched_route_view_idxs = self.query_route_batch([view], route)
+        return rFFs.row(0), familiar_headings[0], matched_route_view_idxs[0]
+
+    # rFFs, most familiar headings and best matched route view indexes of a batch of views from a single forward pass,
+    # reusing the latent space of the rotation that matches each familiar heading. A route name queries that route,
+    # leaving the selected route as it is
+    def query_route_batch(self, views, route=None):
+        with self.selected_route(route):
+            views_preprocessed = np.array([self.preprocess(view) for view in views])
+            pos_tag_vals, latent_spaces = self.get_rotation_scores(views_preprocessed)
+            rFFs = RFF(self.rotation_angles, pos_tag_vals)
+            familiar_headings = self.get_most_familiar_heading(rFFs)
+
+            # Rotations are column shifts, so a familiar heading reuses any rotation with the same shift
+            width = views_preprocessed.shape[2]
+            shift_rotation_idxs = np.full(width, -1)
+            shift_rotation_idxs[self.get_rotation_shifts(width, self.rotation_angles)] = np.arange(len(self.rotation_angles))
+            familiar_rotation_idxs = shift_rotation_idxs[self.get_rotation_shifts(width, familiar_headings)]
+            view_latent_spaces = latent_spaces[torch.arange(len(views)), torch.as_tensor(np.maximum(familiar_rotation_idxs, 0))]
+            unmatched = np.flatnonzero(familiar_rotation_idxs < 0)
+            if len(unmatched) > 0:
+                tensor = self.to_tensor(self.rotate_batch(views_preprocessed[unmatched], familiar_headings[unmatched])).view(-1, self.INPUT_SIZE)
+                with torch.no_grad():
+                    view_latent_spaces[torch.as_tensor(unmatched)] = self.run_model(tensor)[1]
+
+            return rFFs, familiar_headings, self.get_matched_latent_space_idxs(view_latent_spaces)
+
+    # Indexes of the route view latent spaces nearest to a batch of latent spaces, (n_latent_spaces, latent_dim)
+    def get_matched_latent_space_idxs(self, latent_spaces):
+        with torch.no_grad():
+            return torch.argmin(torch.cdist(latent_spaces, self.route_view_layton_spaces), dim=1).cpu().numpy()
 
     # get the index of the best matching route view to a view
     def get_matched_route_view_idx(self, view, view_heading=0):
-        view_preprocessed = self.preprocess(self.rotate(view, view_heading))
-        view_tensor = self.transform(Image.fromarray(view_preprocessed)).float().to(self.device).view(1, self.INPUT_SIZE)
-        self.model(view_tensor)
-        view_latent_space = self.model.get_latent_space()
-        x = {i: torch.cdist(self.route_view_layton_spaces[i], view_latent_space) for i in range(len(self.route_view_layton_spaces))}
-        return min(x, key=x.get)
+        return self.get_matched_route_view_idx_batch([view], [view_heading])[0]
+
+    # get the indexes of the best matching route views to a batch of views
+    def get_matched_route_view_idx_batch(self, views, view_headings):
+        tensor = self.get_view_tensor(self.rotate_batch(views, view_headings)).view(-1, self.INPUT_SIZE)
+        with torch.no_grad():
+            return self.get_matched_latent_space_idxs(self.run_model(tensor)[1])
+
+def _init_train_sweep_worker(n_threads):
+    torch.set_num_threads(n_threads)
+
+def _train_sweep_worker(job):
+    route, vis_deg, rot_deg, resolution, data_path, ANN_flag, hyperparameters, save_path, use_wandb, wandb_mode, resume = job
+    data_name = f"{os.path.basename(data_path)[:-len('.npz')]}_SHARD" if data_path.endswith(".npz") else os.path.basename(data_path)
+    if data_path.endswith(".npz"):
+        train_path, test_path = data_path, data_path
+    else:
+        train_path, test_path = f"{data_path}/TRAIN", f"{data_path}/TEST"
+    ann = ANN(route=route, vis_deg=vis_deg, rot_deg=rot_deg, ANN_flag=ANN_flag, train_path=train_path, test_path=test_path,
+              hyperparameters=hyperparameters, resolution=resolution)
+    run_name = "_".join([ANN_flag] + [f"{name.upper()}-{value}" for name, value in hyperparameters.items()])
+    view_name = f"{resolution[0]}x{resolution[1]}_{vis_deg}_VIS_DEG_{rot_deg}_ROT_DEG"
+    stats = ann.train_model(save_path=f"{save_path}/{ANN_flag}/{route}/{view_name}/TRAINED_ON_{data_name}", save_model=True,
+                            use_wandb=use_wandb, wandb_mode=wandb_mode, run_name=run_name, resume=resume)
+    stats['DATA'] = data_path
+    return stats
+
+# Trains a model for every combination of dataset (an image folder directory with TRAIN and TEST, or a gen_data shard),
+# ANN flag and hyperparameter dict in a pool of worker processes, each limited to threads_per_worker threads. Runs are
+# saved under their view parameters and dataset and named after their hyperparameters, so with resume a rerun sweep
+# skips finished runs and continues interrupted runs from their checkpoints
+def train_sweep(route, data_paths, ANN_flags=("MLP", "RBFNN"), hyperparameters=({},), save_path="ANN_MODELS",
+                workers=None, threads_per_worker=1, use_wandb=False, wandb_mode="offline", resume=True, vis_deg=360,
+                rot_deg=8, resolution=(45, 8)):
+    jobs = [(route, vis_deg, rot_deg, resolution, data_path, ANN_flag, params, save_path, use_wandb, wandb_mode, resume)
+            for data_path, ANN_flag, params in itertools.product(data_paths, ANN_flags, hyperparameters)]
+    if workers is None:
+        workers = max(1, min(len(jobs), os.cpu_count() // threads_per_worker))
+    with multiprocessing.Pool(workers, initializer=_init_train_sweep_worker, initargs=(threads_per_worker,)) as pool:
+        sweep_stats = []
+        for stats in pool.imap(_train_sweep_worker, jobs):
+            print(f"{stats['MODEL']} trained on {stats['DATA']} as {stats['RUN_NAME']} in {stats['TRAIN_TIME']:.1f}s | "
+                  f"Val Acc: {stats['ACCURACY']['val'][-1]:.3f}")
+            sweep_stats.append(stats)
+    return sweep_stats
+
+# Training examples generated on the fly from preprocessed route views. Each route view gives a positive example and,
+# as negatives, either itself rotated by +-angle or a randomly rotated off-route view chosen at random on each access.
+# With fixed_negatives, the off-route view and rotation are seeded by the example, so they're the same on every access
+class ViewDataset(Dataset):
+    def __init__(self, route_views, example_idxs, angle, vis_deg, off_route_views=None, fixed_negatives=False):
+        self.route_views = np.asarray(route_views, dtype=np.uint8)
+        self.example_idxs = np.asarray(example_idxs)
+        self.angle = angle
+        self.vis_deg = vis_deg
+        self.off_route_views = off_route_views
+        self.fixed_negatives = fixed_negatives
+        self.n_examples_per_view = 3 if off_route_views is None else 2
+        self.route_view_bank = None
+
+    # The rotation bank is rebuilt lazily rather than pickled, which would copy out every rotation
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['route_view_bank'] = None
+        return state
+
+    def __len__(self):
+        return len(self.example_idxs)
+
+    def __getitem__(self, idx):
+        example_idx = int(self.example_idxs[idx])
+        route_view_idx, example = divmod(example_idx, self.n_examples_per_view)
+        if example == 0:
+            view, label = self.route_views[route_view_idx], 1
+        elif self.off_route_views is None:
+            if self.route_view_bank is None:
+                self.route_view_bank = AnalysisToolkit.get_rotation_bank(self.route_views)
+            view, label = self.route_view_bank[route_view_idx, self.get_shift(self.angle if example == 1 else -self.angle)], 0
+        else:
+            rng = random.Random(example_idx) if self.fixed_negatives else random
+            off_route_view = self.off_route_views[rng.randrange(len(self.off_route_views))]
+            # A single rotation of a single view, so rolled directly rather than through a rotation bank
+            view, label = np.roll(off_route_view, self.get_shift(rng.randint(0, 360)), axis=1), 0
+        return torch.from_numpy(np.ascontiguousarray(view)).float().div(255).unsqueeze(0), label
+
+    # Column shift of a rotation by angle, as rotate applies it
+    def get_shift(self, angle):
+        width = self.route_views.shape[2]
+        return int(width * (angle / self.vis_deg)) % width
+
+# Returns the logits and latent space of a model from a single call, so both survive tracing
+class InferenceModel(nn.Module):
+    def __init__(self, model):
+        nn.Module.__init__(self)
+        self.model = model
+
+    def forward(self, inputs):
+        logits = self.model(inputs)
+        return logits, self.model.get_latent_space()
 
 class MLPModel(nn.Module):
     def __init__(self, INPUT_SIZE):
@@ -313,12 +684,12 @@ class RBF(nn.Module):
         nn.init.normal_(self.centres, 0, 1)
         nn.init.constant_(self.log_sigmas, 0)
 
+    # Distances to the centres from ||x||^2 - 2x.c + ||c||^2, without expanding inputs and centres to
+    # (batch, out_features, in_features)
     def forward(self, inputs):
-        size = (inputs.size(0), self.out_features, self.in_features)
-        x = inputs.unsqueeze(1).expand(size)
-        c = self.centres.unsqueeze(0).expand(size)
-        distances = (x - c).pow(2).sum(-1).pow(0.5) / torch.exp(self.log_sigmas).unsqueeze(0)
-        # distances = torch.sqrt(torch.sum((x - c).pow(2))).unsqueeze(0)
+        squared_distances = torch.addmm(self.centres.pow(2).sum(-1).unsqueeze(0), inputs, self.centres.t(), alpha=-2)
+        squared_distances = squared_distances + inputs.pow(2).sum(-1, keepdim=True)
+        distances = squared_distances.clamp_min(0).sqrt() / torch.exp(self.log_sigmas).unsqueeze(0)
         return self.basis_func(distances, self.basis_func_flag)
 
     def basis_func(self, alpha, BASIS_FUNC_FLAG):
@@ -348,6 +719,8 @@ if __name__ == '__main__':
 
     # ann.gen_data(angle=0, is_random=True, split=0.2)
     # ann.train_model(save_path=f"ANN_MODELS/{ANN_flag}/{route_name}/TRAINED_ON_{data_path}", save_model=True)
+    # train_sweep(route_name, [f"ANN_DATA/{route_name}/{deg}_DEGREES_DATA" for deg in [0, 10, 20, 45, 60, 90, 120, 180]] +
+    #             [f"ANN_DATA/{route_name}/RAND_DATA"], ANN_flags=["MLP", "RBFNN"], save_path="ANN_MODELS")
 
     ann.load_model(f"ANN_MODELS/{ANN_flag}/{route_name}/TRAINED_ON_{data_path}/{model_name}.pth")
     # ann.test_model()
@@ -436,7 +809,7 @@ if __name__ == '__main__':
     save_data = True
     coor = [510, 250]
 
-    image = cv2.imread(ann.grid_path + ann.grid_filenames[(coor[0], coor[1])])
+    image = ann.read_image(ann.grid_path, ann.grid_filenames[(coor[0], coor[1])])
 
     rFF = ann.get_route_rFF(image)
 
@@ -8,13 +8,26 @@ import cv2
 from pyprobar import probar
 import datetime
 import csv
+import io
 import itertools
+import multiprocessing
 import os
 import seaborn as sns
 
+# Model held by each database analysis worker process, initialised once per worker
+_worker_model = None
+
+def _init_database_analysis_worker(model):
+    global _worker_model
+    _worker_model = model
+    _worker_model.init_worker()
+
+def _database_analysis_worker(chunk):
+    return _worker_model.database_analysis_chunk(chunk)
+
 class AnalysisToolkit(FunctionToolkit):
-    def __init__(self, route, vis_deg, rot_deg):
-        FunctionToolkit.__init__(self, route, vis_deg, rot_deg)
+    def __init__(self, route, vis_deg, rot_deg, resolution=(45, 8)):
+        FunctionToolkit.__init__(self, route, vis_deg, rot_deg, resolution)
 
         time = datetime.datetime.now()
         self.time = "%s-%s-%s_%s-%s-%s" % (time.day, time.month, time.year, time.hour, time.minute, time.second)
@@ -24,18 +37,6 @@ class AnalysisToolkit(FunctionToolkit):
             os.makedirs(path)
         plot.savefig(f"{path}/{filename} {str(self.time)}.png")
 
-    def save_dict_as_CSV(self, data, path="", filename=""):
-        keys = data[0].keys()
-        if not os.path.isdir(path):
-            os.makedirs(path)
-        try:
-            with open(f"{path}/{str(self.time)}_{filename}.csv", 'w', newline='') as csvfile:
-                dict_writer = csv.DictWriter(csvfile, keys)
-                dict_writer.writeheader()
-                dict_writer.writerows(data)
-        except IOError:
-            print("I/O error")
-
     def rFF_plot(self, rFF, title, ylim=None, ybound=None, save_path="VIEW_ANALYSIS", save_data=False):
         fig, ax = plt.subplots()
         ax.plot(*zip(*sorted(rFF.items())))
@@ -69,7 +70,10 @@ class AnalysisToolkit(FunctionToolkit):
                           title=f"{model_name} rFF of view ({x}) at {pos} vs route memories",
                           save_path=save_path, save_data=save_data)
 
-    def database_analysis(self, spacing, bounds=None, corridor=None, save_path="DATABASE_ANALYSIS", save_data=False):
+    # Analyses the database a chunk of coordinates at a time, streaming each chunk's rows to the output CSV and flushing
+    # it as the chunk completes. resume_path continues a partial output CSV instead, skipping the coordinates it holds
+    def database_analysis(self, spacing, bounds=None, corridor=None, save_path="DATABASE_ANALYSIS", save_data=False,
+                          chunk_size=100, workers=1, resume_path=None):
         if bounds is None:
             bounds = self.bounds
 
@@ -82,25 +86,72 @@ class AnalysisToolkit(FunctionToolkit):
         else:
             quiver_coors = [(x, y) for x in x_ticks for y in y_ticks]
 
-        cm = plt.get_cmap('YlOrRd')
-        line_map = [cm(1. * i / len(self.route_X)) for i in range(len(self.route_X))]
-        quiver_map = []
-
-        data = []
-        for x, y in probar(quiver_coors):
-            view = cv2.imread(self.grid_path + self.grid_filenames.get((x, y)))
-
-            rFF = self.get_route_rFF(view)
-            familiar_heading = self.get_most_familiar_heading(rFF)
-
-            matched_route_view_idx = self.get_matched_route_view_idx(view=view, view_heading=familiar_heading)
-            quiver_map.append(line_map[matched_route_view_idx])
-
-            data.append({"X_COOR": x, "Y_COOR": y, "HEADING": familiar_heading, "MATCHED_ROUTE_VIEW_IDX": matched_route_view_idx})
-
-        if save_data:
+        csvfile, dict_writer = None, None
+        if resume_path is not None:
+            fieldnames, completed_coors = self.load_partial_CSV(resume_path)
+            quiver_coors = [(x, y) for x, y in quiver_coors if (x, y) not in completed_coors]
+            csvfile = open(resume_path, 'a', newline='')
+            if fieldnames is not None:
+                dict_writer = csv.DictWriter(csvfile, fieldnames)
+        elif save_data:
+            if not os.path.isdir(save_path):
+                os.makedirs(save_path)
             filename = f"{self.route_name}_{str(np.ptp(x_ticks))}x{str(np.ptp(y_ticks))}_{str(spacing)}"
-            self.save_dict_as_CSV(data, save_path, filename)
+            csvfile = open(f"{save_path}/{str(self.time)}_{filename}.csv", 'w', newline='')
+
+        chunks = [quiver_coors[i:i + chunk_size] for i in range(0, len(quiver_coors), chunk_size)]
+        try:
+            for chunk_data in self.iter_database_analysis(chunks, workers):
+                if csvfile is None:
+                    continue
+                if dict_writer is None:
+                    dict_writer = csv.DictWriter(csvfile, chunk_data[0].keys())
+                    dict_writer.writeheader()
+                dict_writer.writerows(chunk_data)
+                csvfile.flush()
+        finally:
+            if csvfile is not None:
+                csvfile.close()
+
+    # Rows of each chunk of coordinates, in chunk order whether analysed serially or by a pool of workers. The grid view
+    # cache is built once, before the pool is created, and shared by every worker
+    def iter_database_analysis(self, chunks, workers=1):
+        if workers > 1:
+            self.resolve_grid_view_cache()
+            with multiprocessing.Pool(workers, initializer=_init_database_analysis_worker, initargs=(self,)) as pool:
+                yield from probar(pool.imap(_database_analysis_worker, chunks), total_steps=len(chunks))
+        else:
+            for chunk in probar(chunks):
+                yield self.database_analysis_chunk(chunk)
+
+    # Header and completed coordinates of a partial database analysis CSV, truncating a partly written last row. A
+    # missing file is an empty one, so resuming a run that never started starts it
+    def load_partial_CSV(self, path):
+        if not os.path.isfile(path):
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            return None, set()
+        with open(path, 'rb+') as csvfile:
+            contents = csvfile.read()
+            complete_length = contents.rfind(b"\n") + 1
+            if complete_length < len(contents):
+                csvfile.truncate(complete_length)
+        reader = csv.DictReader(io.StringIO(contents[:complete_length].decode(), newline=''))
+        completed_coors = {(int(row["X_COOR"]), int(row["Y_COOR"])) for row in reader}
+        return reader.fieldnames, completed_coors
+
+    # Familiar heading and best matched route view for each coordinate of a chunk of the database
+    def database_analysis_chunk(self, chunk):
+        views = [self.get_grid_view(x, y) for x, y in chunk]
+
+        rFFs, familiar_headings, matched_route_view_idxs = self.query_route_batch(views)
+
+        return [{"X_COOR": x, "Y_COOR": y, "HEADING": familiar_heading, "MATCHED_ROUTE_VIEW_IDX": matched_route_view_idx}
+                for (x, y), familiar_heading, matched_route_view_idx in zip(chunk, familiar_headings, matched_route_view_idxs)]
+
+    # Called once in each database analysis worker process before it receives any chunks
+    def init_worker(self):
+        pass
 
     def show_database_analysis_plot(self, data_path, spacing, bounds=None, locationality=True,
                                     save_path="DATABASE_ANALYSIS", save_data=False):
@@ -152,15 +203,15 @@ class AnalysisToolkit(FunctionToolkit):
         heading_errors = []
         indexes = []
         for idx, data_path in enumerate(data_paths):
-            data = csv.DictReader(open(data_path))
-            heading_errors.append([abs(self.get_ground_truth_heading(int(row['X_COOR']), int(row['Y_COOR'])) - int(row['HEADING'])) for row in data])
+            evaluation = self.evaluate(data_path)
+            heading_errors.append(list(evaluation["ABS_ERRORS"]))
             if locationality:
-                info_titles = f"AVG DIRECTIONAL ERROR: {round(self.avg_absolute_error(data_path), 2)}\n" \
-                              f"DIRECTIONALLY CORRECT: {round(self.directionally_correct(data_path), 2)}%\n" \
-                              f"LOCATIONALLY CORRECT: {round(self.locationally_correct(data_path), 2)}%"
+                info_titles = f"AVG DIRECTIONAL ERROR: {round(evaluation['AVG_ABS_ERROR'], 2)}\n" \
+                              f"DIRECTIONALLY CORRECT: {round(evaluation['DIRECTIONALLY_CORRECT'], 2)}%\n" \
+                              f"LOCATIONALLY CORRECT: {round(evaluation['LOCATIONALLY_CORRECT'], 2)}%"
             else:
-                info_titles = f"AVG DIRECTIONAL ERROR: {round(self.avg_absolute_error(data_path), 2)}\n" \
-                              f"DIRECTIONALLY CORRECT: {round(self.directionally_correct(data_path), 2)}%\n"
+                info_titles = f"AVG DIRECTIONAL ERROR: {round(evaluation['AVG_ABS_ERROR'], 2)}\n" \
+                              f"DIRECTIONALLY CORRECT: {round(evaluation['DIRECTIONALLY_CORRECT'], 2)}%\n"
             if index_titles is not None:
                 indexes.append(f"{index_titles[idx]}\n{info_titles}")
             else:
@@ -211,13 +262,13 @@ class AnalysisToolkit(FunctionToolkit):
         self.rFF_plot(rFF=rFF, title="rFF", ylim=None, save_data=save_data)
 
     def ground_truth_view_analysis(self, view_x, view_y, ybound=None, view_heading=0, save_data=False):
-        view = cv2.imread(self.grid_path + self.grid_filenames.get((view_x, view_y)))
+        view = self.get_grid_view(view_x, view_y)
 
-        ground_truth_view_coor = self.get_ground_truth_coor(view_x, view_y)
-        ground_truth_view_idx = list(zip(self.route_X, self.route_Y)).index(ground_truth_view_coor)
+        ground_truth_view_idx = self.get_ground_truth_idxs(view_x, view_y)[0]
+        ground_truth_view_coor = (self.route_X[ground_truth_view_idx], self.route_Y[ground_truth_view_idx])
         ground_truth_view_filename = self.route_filenames[ground_truth_view_idx]
         ground_truth_view_heading = self.route_headings[ground_truth_view_idx]
-        ground_truth_view = cv2.imread(self.route_path + ground_truth_view_filename)
+        ground_truth_view = self.read_image(self.route_path, ground_truth_view_filename)
 
         rFF = self.get_view_rFF(view, ground_truth_view, view_heading)
         if ybound is None:
@@ -252,12 +303,12 @@ class AnalysisToolkit(FunctionToolkit):
                       ylim=[0, 1], ybound=[round(ybound[0]), round(ybound[1])], save_data=save_data)
 
     def best_matched_view_analysis(self, view_x, view_y, ybound=None, view_heading=0, save_data=False):
-        view = cv2.imread(self.grid_path + self.grid_filenames.get((view_x,view_y)))
+        view = self.get_grid_view(view_x, view_y)
 
         matched_route_view_idx = self.get_matched_route_view_idx(view)
         matched_route_view_filename = self.route_filenames[matched_route_view_idx]
         matched_route_view_heading = self.route_headings[matched_route_view_idx]
-        matched_route_view = cv2.imread(self.route_path + matched_route_view_filename)
+        matched_route_view = self.read_image(self.route_path, matched_route_view_filename)
 
         route_rFF = self.get_route_rFF(view, view_heading)
         if ybound is None:
@@ -360,10 +411,12 @@ class AnalysisToolkit(FunctionToolkit):
         x_ticks = np.arange(bounds[0][0], bounds[1][0] + 1, spacing, dtype=int)
         y_ticks = np.arange(bounds[1][1], bounds[0][1] - 1, -spacing, dtype=int)
 
-        pm_df = pd.read_csv(open(pm_data_path))
-        pm_df["ABS_HEADING_ERROR"] = self.absolute_errors(pm_data_path)
-        mlp_df = pd.read_csv(open(mlp_data_path))
-        mlp_df["ABS_HEADING_ERROR"] = self.absolute_errors(mlp_data_path)
+        pm_evaluation = self.evaluate(pm_data_path)
+        pm_df = pm_evaluation["DATA"]
+        pm_df["ABS_HEADING_ERROR"] = pm_evaluation["ABS_ERRORS"]
+        mlp_evaluation = self.evaluate(mlp_data_path)
+        mlp_df = mlp_evaluation["DATA"]
+        mlp_df["ABS_HEADING_ERROR"] = mlp_evaluation["ABS_ERRORS"]
 
         diff_df = pd.merge(pm_df, mlp_df, how='inner', on=["X_COOR", "Y_COOR"])
         diff_df["HEADING_DIFF"] = diff_df["ABS_HEADING_ERROR_x"] - diff_df["ABS_HEADING_ERROR_y"]
@@ -4,53 +4,329 @@ import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.ticker as plticker
 import cv2
+from RFF import RFF
+from ImageDatabase import ImageDatabase
+from KeyedCache import KeyedCache
+from scipy.spatial import cKDTree
 from pyprobar import probar
 import datetime
-import csv
+import contextlib
 import itertools
+import hashlib
+import io
 import os
 
 class FunctionToolkit:
-    def __init__(self, route, vis_deg, rot_deg):
-        self.route_name = route
+    # route is a route name, or a list of them to hold several route memories against the one grid database.
+    # resolution is the (width, height) views are preprocessed to
+    def __init__(self, route, vis_deg, rot_deg, resolution=(45, 8)):
         self.vis_deg = vis_deg
         self.rot_deg = rot_deg
+        self.rotation_angles = np.arange(0, vis_deg, step=rot_deg, dtype=int)
+        self.resolution = tuple(resolution)
 
-        self.topdown_view = plt.imread("ant_world_image_databases/topdown_view.png")
+        # Top-down view of the world, read on first use
+        self._topdown_view = None
+
+        self.cache_path = "ant_world_image_databases/CACHE/"
         self.grid_path = "ant_world_image_databases/grid/"
-        grid_data = pd.read_csv("ant_world_image_databases/grid/database_entries.csv", skipinitialspace=True)
-        self.grid_X = [int(x/10) for x in np.array(grid_data['X [mm]'])]
-        self.grid_Y = [int(y/10) for y in np.array(grid_data['Y [mm]'])]
-        self.grid_filenames = {(int(grid_data['X [mm]'][idx]/10), int(grid_data['Y [mm]'][idx]/10)): filename
-                               for idx, filename in enumerate(grid_data['Filename'])}
-
-        self.route_path = "ant_world_image_databases/routes/"+route+"/"
-        route_data = pd.read_csv(self.route_path+"database_entries.csv", skipinitialspace=True)
-        self.route_filenames = np.array(route_data['Filename'])
-        self.route_X = [int(x/10) for x in np.array(route_data['X [mm]'])]
-        self.route_Y = [int(y/10) for y in np.array(route_data["Y [mm]"])]
-        self.route_headings = np.array([int(rot_deg * round(float(heading)/rot_deg)) for heading in route_data['Heading [degrees]']])
-
-        self.bounds = [[int((np.floor((min(self.route_X) / 10)) * 10)), int((np.floor((min(self.route_Y) / 10)) * 10))],
-                        [int((np.ceil((max(self.route_X) / 10)) * 10)), int((np.ceil((max(self.route_Y) / 10)) * 10))]]
+        grid_data = self.load_database_index(self.grid_path, "grid_index_")
+        grid_coors = list(zip(grid_data['X'].tolist(), grid_data['Y'].tolist()))
+        self.grid_X = grid_data['X'].tolist()
+        self.grid_Y = grid_data['Y'].tolist()
+        self.grid_filenames = dict(zip(grid_coors, grid_data['FILENAME'].tolist()))
+        self.grid_view_idxs = dict(zip(grid_coors, range(len(grid_coors))))
+        self.grid_database_filenames = grid_data['FILENAME'].astype(object)
+
+        # Memory-mapped preprocessed grid views and the path of their cache, opened and resolved on first use
+        self.grid_views = None
+        self.grid_view_cache_path = None
+        # Packed image databases by database directory, opened on first use
+        self.image_databases = {}
+
+        # Per-route attributes of every route, the selected route's being set on the toolkit itself
+        self.route_names = [route] if isinstance(route, str) else list(route)
+        self.route_states = {route_name: self.load_route(route_name) for route_name in self.route_names}
+        self.select_route(self.route_names[0])
+
+    @property
+    def topdown_view(self):
+        if self._topdown_view is None:
+            self._topdown_view = plt.imread("ant_world_image_databases/topdown_view.png")
+        return self._topdown_view
+
+    # Coordinates (in cm), filenames and, for routes, headings of the entries of a database_entries.csv. The parsed
+    # entries are cached as a binary index keyed by the CSV contents
+    def load_database_index(self, database_path, prefix):
+        with open(database_path + "database_entries.csv", 'rb') as csvfile:
+            contents = csvfile.read()
+        cache = KeyedCache(self.cache_path, prefix, ".npz")
+        key = hashlib.sha1(contents).hexdigest()
+        path = cache.get_path(key)
+        if os.path.isfile(path):
+            with np.load(path) as index:
+                return {name: index[name] for name in index.files}
+        data = pd.read_csv(io.BytesIO(contents), skipinitialspace=True)
+        index = {'FILENAME': np.array(data['Filename'], dtype=str),
+                 'X': (np.array(data['X [mm]'], dtype=float) / 10).astype(int),
+                 'Y': (np.array(data['Y [mm]'], dtype=float) / 10).astype(int)}
+        if 'Heading [degrees]' in data:
+            index['HEADING'] = np.array(data['Heading [degrees]'], dtype=float)
+        # Indexes invalidated by changes to the CSV are pruned
+        with cache.write(key) as tmp_path, open(tmp_path, 'wb') as indexfile:
+            np.savez(indexfile, **index)
+        return index
+
+    def load_route(self, route):
+        route_path = "ant_world_image_databases/routes/"+route+"/"
+        route_data = self.load_database_index(route_path, f"route_{route}_index_")
+        route_X = route_data['X'].tolist()
+        route_Y = route_data['Y'].tolist()
+        route_headings = (self.rot_deg * np.round(route_data['HEADING'] / self.rot_deg)).astype(int)
+
+        # Spatial index over the distinct route positions, each mapped to the first route view recorded there
+        route_unique_coors, route_unique_idxs = np.unique(np.column_stack([route_X, route_Y]), axis=0, return_index=True)
+
+        bounds = [[int((np.floor((min(route_X) / 10)) * 10)), int((np.floor((min(route_Y) / 10)) * 10))],
+                  [int((np.ceil((max(route_X) / 10)) * 10)), int((np.ceil((max(route_Y) / 10)) * 10))]]
+        return {"route_name": route, "route_path": route_path, "route_filenames": route_data['FILENAME'].astype(object),
+                "route_X": route_X, "route_Y": route_Y, "route_headings": route_headings,
+                "route_unique_coors": route_unique_coors, "route_unique_idxs": route_unique_idxs,
+                "route_tree": cKDTree(route_unique_coors), "bounds": bounds}
+
+    # Makes a route the one that route attributes, memories and queries refer to
+    def select_route(self, route):
+        self.__dict__.update(self.route_states[route])
 
+    # Selects a route for the duration of a with block, selecting the previously selected route again after it. None
+    # leaves the selected route as it is
+    @contextlib.contextmanager
+    def selected_route(self, route=None):
+        route_name = self.route_name
+        if route is not None:
+            self.select_route(route)
+        try:
+            yield
+        finally:
+            self.select_route(route_name)
+
+    # Sets attributes of the selected route, kept with it when another route is selected
+    def set_route_state(self, **route_state):
+        self.route_states[self.route_name].update(route_state)
+        self.__dict__.update(route_state)
+
+    # The grid view cache and top-down view are reopened lazily in worker processes rather than pickled
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['grid_views'] = None
+        state['_topdown_view'] = None
+        return state
+
+    # Views that are already preprocessed, e.g. from the grid view cache, are returned unchanged
     def preprocess(self, view):
-        view = cv2.cvtColor(view, cv2.COLOR_BGR2GRAY)
-        return cv2.resize(view, (45, 8))
+        return self.preprocess_pyramid(view, [self.resolution])[0]
+
+    # A view preprocessed to each of a list of resolutions, converting it to greyscale once
+    def preprocess_pyramid(self, view, resolutions):
+        if view.ndim == 3:
+            view = cv2.cvtColor(view, cv2.COLOR_BGR2GRAY)
+        return [view if view.shape == (resolution[1], resolution[0]) else cv2.resize(view, tuple(resolution))
+                for resolution in resolutions]
+
+    # Changes the resolution views are preprocessed to. Route views and grid views are reloaded at the new resolution,
+    # from the pyramids built by build_pyramid if they hold it. Packed databases of preprocessed views are checked against
+    # the new resolution first, so a resolution they can't be read at leaves the toolkit unchanged
+    def set_resolution(self, resolution):
+        for database_path in [self.grid_path] + [route_state['route_path'] for route_state in self.route_states.values()]:
+            self.get_readable_image_database(database_path, resolution)
+        self.resolution = tuple(resolution)
+        self.grid_views = None
+        self.grid_view_cache_path = None
+
+    # Preprocesses the route views of every route and the grid views to each of a list of resolutions, decoding each
+    # image once. Route views are kept in memory and grid views are written to the grid view cache of each resolution
+    def build_pyramid(self, resolutions):
+        resolutions = [tuple(resolution) for resolution in resolutions]
+        for route in self.route_names:
+            with self.selected_route(route):
+                route_view_pyramids = [self.preprocess_pyramid(view, resolutions)
+                                       for view in self.read_images(self.route_path, self.route_filenames)]
+                self.set_route_state(route_view_pyramid={resolution: np.array([pyramid[idx] for pyramid in route_view_pyramids])
+                                                         for idx, resolution in enumerate(resolutions)})
+        self.build_grid_view_caches(resolutions)
+
+    # Packed image database of a grid or route database directory, opened on first use, or None if it isn't packed
+    def get_image_database(self, database_path):
+        if database_path not in self.image_databases:
+            path = database_path.rstrip("/") + ".imgdb"
+            self.image_databases[database_path] = ImageDatabase(path) if os.path.isfile(path) else None
+        return self.image_databases[database_path]
+
+    # Packed image database to read a database's images from. Preprocessed views are only read at the resolution they
+    # were packed at, as preprocess would otherwise resize them. resolution defaults to the current resolution
+    def get_readable_image_database(self, database_path, resolution=None):
+        resolution = self.resolution if resolution is None else tuple(resolution)
+        image_database = self.get_image_database(database_path)
+        if image_database is not None and image_database.format == 'RAW' and image_database.shape != resolution[::-1]:
+            raise ValueError(f"{image_database.path} holds views preprocessed to {image_database.shape[1]}x{image_database.shape[0]}, "
+                             f"not {resolution[0]}x{resolution[1]}")
+        return image_database
+
+    # Image of a grid or route database, read from its packed image database in place of the PNG file if it's packed
+    def read_image(self, database_path, filename):
+        image_database = self.get_readable_image_database(database_path)
+        if image_database is None:
+            return cv2.imread(database_path + filename)
+        return image_database.read(filename)
+
+    def read_images(self, database_path, filenames):
+        image_database = self.get_readable_image_database(database_path)
+        if image_database is None:
+            return [cv2.imread(database_path + filename) for filename in filenames]
+        return image_database.read_many(filenames)
+
+    # Packs the grid and every route database into one .imgdb file each, next to its directory, as the PNG files or,
+    # if preprocessed, as preprocessed views. Later reads of those databases go through the packed files
+    def pack_image_databases(self, preprocessed=False):
+        grid_data = self.load_database_index(self.grid_path, "grid_index_")
+        databases = [(self.grid_path, grid_data['FILENAME'].tolist(), list(zip(grid_data['X'], grid_data['Y'])))]
+        for route_state in self.route_states.values():
+            databases.append((route_state['route_path'], list(route_state['route_filenames']),
+                              list(zip(route_state['route_X'], route_state['route_Y']))))
+        for database_path, filenames, coors in databases:
+            print(f"Packing {database_path}...")
+            if preprocessed:
+                read_image = lambda filename: self.preprocess(cv2.imread(database_path + filename))
+            else:
+                read_image = lambda filename: np.fromfile(database_path + filename, dtype=np.uint8).tobytes()
+            ImageDatabase.pack(database_path.rstrip("/") + ".imgdb", filenames, coors, read_image, preprocessed)
+        self.image_databases = {}
+
+    # Updates a cache key with the images of a database, using the packed image database if there is one
+    def update_database_key(self, key, database_path, filenames):
+        image_database = self.get_image_database(database_path)
+        if image_database is not None:
+            stat = os.stat(image_database.path)
+            key.update(f"{image_database.path}_{stat.st_size}_{stat.st_mtime_ns}".encode())
+            return
+        for filename in filenames:
+            stat = os.stat(database_path + filename)
+            key.update(f"{filename}_{stat.st_size}_{stat.st_mtime_ns}".encode())
+
+    # Stack of every preprocessed route view, (n_route_views, H, W)
+    def load_route_views(self):
+        if self.resolution in self.route_states[self.route_name].get('route_view_pyramid', {}):
+            return self.route_view_pyramid[self.resolution]
+        return np.array([self.preprocess(view) for view in self.read_images(self.route_path, self.route_filenames)])
+
+    # Cache key covering the preprocessing parameters, the grid database CSV and every grid image
+    def get_grid_view_cache_key(self, resolution):
+        key = hashlib.sha1(f"BGR2GRAY_{resolution[0]}x{resolution[1]}".encode())
+        with open(self.grid_path + "database_entries.csv", 'rb') as csvfile:
+            key.update(csvfile.read())
+        self.update_database_key(key, self.grid_path, self.grid_database_filenames)
+        return key.hexdigest()
+
+    # Preprocesses every grid view into a single .npy file, once per cache key, and returns its path
+    def build_grid_view_cache(self):
+        return self.build_grid_view_caches([self.resolution])[0]
+
+    # Grid view cache paths for each of a list of resolutions, building the missing caches from one decoding pass
+    def build_grid_view_caches(self, resolutions):
+        caches = [KeyedCache(self.cache_path, f"grid_{resolution[0]}x{resolution[1]}_", ".npy") for resolution in resolutions]
+        keys = [self.get_grid_view_cache_key(resolution) for resolution in resolutions]
+        paths = [cache.get_path(key) for cache, key in zip(caches, keys)]
+        missing = [idx for idx, path in enumerate(paths) if not os.path.isfile(path)]
+        if len(missing) == 0:
+            return paths
+        print("Building grid view cache...")
+        # Caches invalidated by changes to the grid database are pruned
+        with contextlib.ExitStack() as stack:
+            tmp_paths = [stack.enter_context(caches[idx].write(keys[idx])) for idx in missing]
+            grid_views = [np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                                    shape=(len(self.grid_database_filenames), resolutions[idx][1], resolutions[idx][0]))
+                          for idx, tmp_path in zip(missing, tmp_paths)]
+            chunk_size = 256
+            for start in probar(range(0, len(self.grid_database_filenames), chunk_size)):
+                views = self.read_images(self.grid_path, self.grid_database_filenames[start:start + chunk_size])
+                pyramids = [self.preprocess_pyramid(view, [resolutions[idx] for idx in missing]) for view in views]
+                for level, level_views in enumerate(grid_views):
+                    level_views[start:start + len(views)] = [pyramid[level] for pyramid in pyramids]
+            for level_views in grid_views:
+                level_views.flush()
+            del grid_views, level_views
+        return paths
+
+    # Path of the grid view cache at the current resolution, building the cache and hashing the grid database only on
+    # the first call. Resolved before forking worker processes, which then map the cache without rehashing
+    def resolve_grid_view_cache(self):
+        if self.grid_view_cache_path is None:
+            self.grid_view_cache_path = self.build_grid_view_cache()
+        return self.grid_view_cache_path
+
+    def load_grid_view_cache(self):
+        self.grid_views = np.load(self.resolve_grid_view_cache(), mmap_mode='r')
+
+    # Preprocessed grid view at a coordinate, read from the grid view cache
+    def get_grid_view(self, x, y):
+        if self.grid_views is None:
+            self.load_grid_view_cache()
+        return self.grid_views[self.grid_view_idxs[(x, y)]]
 
     def rotate(self, view, angle):
         return np.roll(view, int(view.shape[1] * (angle / self.vis_deg)), axis=1)
 
+    # Column shifts that rotate applies to a view of the given width for each angle
+    def get_rotation_shifts(self, width, angles):
+        return np.array([int(width * (angle / self.vis_deg)) for angle in angles], dtype=int)
+
+    # Every column shift of a preprocessed view, or a batch of them, as a read-only strided view over a horizontally
+    # wrapped copy, (..., W, H, W). bank[..., s, :, :] is the view rotated by s columns, as rotate rotates it for any
+    # angle with that shift, without copying any rotation
+    @staticmethod
+    def get_rotation_bank(views):
+        views = np.asarray(views)
+        width = views.shape[-1]
+        wrapped = np.concatenate([views, views], axis=-1)
+        return np.lib.stride_tricks.as_strided(wrapped[..., width:], shape=views.shape[:-2] + (width,) + views.shape[-2:],
+                                               strides=wrapped.strides[:-2] + (-wrapped.strides[-1],) + wrapped.strides[-2:],
+                                               writeable=False)
+
+    # Views each rotated by its own angle. Batches of preprocessed views are gathered from their rotation bank
+    def rotate_batch(self, views, angles):
+        if all(np.ndim(view) == 2 for view in views) and len({np.shape(view) for view in views}) == 1:
+            views = np.asarray(views)
+            shifts = self.get_rotation_shifts(views.shape[-1], angles) % views.shape[-1]
+            return self.get_rotation_bank(views)[np.arange(len(views)), shifts]
+        return [self.rotate(view, angle) for view, angle in zip(views, angles)]
+
     def image_difference(self, minuend, subtrahend):
         return abs(minuend.astype("float") - subtrahend.astype("float"))
 
+    # Indexes of the nearest route views to arrays of coordinates, the earliest route view winning ties
+    def get_ground_truth_idxs(self, xs, ys):
+        coors = np.column_stack([np.ravel(xs), np.ravel(ys)])
+        k = min(8, len(self.route_unique_idxs))
+        candidates = self.route_tree.query(coors, k=k)[1].reshape(len(coors), k)
+        sq_dists = np.sum((self.route_unique_coors[candidates] - coors[:, np.newaxis]) ** 2, axis=2)
+        is_nearest = sq_dists == sq_dists.min(axis=1, keepdims=True)
+        idxs = np.where(is_nearest, self.route_unique_idxs[candidates], len(self.route_X)).min(axis=1)
+        # Nearest candidates may be cut off by k when every candidate is equidistant, so scan those queries fully
+        for i in np.flatnonzero(is_nearest.all(axis=1) & (k < len(self.route_unique_idxs))):
+            all_sq_dists = np.sum((self.route_unique_coors - coors[i]) ** 2, axis=1)
+            idxs[i] = self.route_unique_idxs[all_sq_dists == all_sq_dists.min()].min()
+        return idxs
+
     def get_ground_truth_coor(self, x, y):
-        return min(zip(self.route_X, self.route_Y), key=lambda route_coor: ((route_coor[0] - x) ** 2 + (route_coor[1] - y) ** 2))
+        idx = self.get_ground_truth_idxs(x, y)[0]
+        return self.route_X[idx], self.route_Y[idx]
 
     def get_ground_truth_heading(self, x, y):
-        return self.route_headings[list(zip(self.route_X, self.route_Y)).index(self.get_ground_truth_coor(x, y))]
+        return self.route_headings[self.get_ground_truth_idxs(x, y)[0]]
 
     def normalize(self, d, min, max=0):
+        if isinstance(d, RFF):
+            return d.normalize(min, max)
         return {k: ((v - min) / (max - min)) for k, v in d.items()}
 
     def is_within_prcnt(self, a, b, prcnt):
@@ -58,39 +334,40 @@ class FunctionToolkit:
             return a == 0
         return prcnt > abs(abs(b-a)/b)*100.0
 
+    # Loads a database analysis CSV once and evaluates every row against the route ground truth in one pass
+    def evaluate(self, data_path):
+        directional_threshold, locational_threshold = 20, 75
+        data = pd.read_csv(data_path)
+        ground_truth_view_idxs = self.get_ground_truth_idxs(data['X_COOR'], data['Y_COOR'])
+        real_headings = self.route_headings[ground_truth_view_idxs]
+        headings = data['HEADING'].values
+
+        evaluation = {"DATA": data, "GROUND_TRUTH_VIEW_IDXS": ground_truth_view_idxs}
+        evaluation["ABS_ERRORS"] = np.abs(real_headings - headings)
+        evaluation["AVG_ABS_ERROR"] = float(np.mean(evaluation["ABS_ERRORS"]))
+        evaluation["DIRECTIONALLY_CORRECT_ROWS"] = (((real_headings - directional_threshold) % self.vis_deg <= headings) &
+                                                    (headings <= (real_headings + directional_threshold) % self.vis_deg))
+        evaluation["DIRECTIONALLY_CORRECT"] = float(np.mean(evaluation["DIRECTIONALLY_CORRECT_ROWS"]))*100
+        if 'MATCHED_ROUTE_VIEW_IDX' in data:
+            matched_route_view_idxs = data['MATCHED_ROUTE_VIEW_IDX'].values
+            route_X, route_Y = np.array(self.route_X), np.array(self.route_Y)
+            evaluation["LOCATIONAL_ERRORS"] = np.sqrt(np.square(route_X[ground_truth_view_idxs] - route_X[matched_route_view_idxs]) +
+                                                      np.square(route_Y[ground_truth_view_idxs] - route_Y[matched_route_view_idxs]))
+            evaluation["LOCATIONALLY_CORRECT_ROWS"] = evaluation["LOCATIONAL_ERRORS"] <= locational_threshold
+            evaluation["LOCATIONALLY_CORRECT"] = float(np.mean(evaluation["LOCATIONALLY_CORRECT_ROWS"]))*100
+        return evaluation
+
     def absolute_errors(self, data_path):
-        data = csv.DictReader(open(data_path))
-        errors = []
-        for row in data:
-            real_heading = self.get_ground_truth_heading(int(row['X_COOR']), int(row['Y_COOR']))
-            errors.append(abs(real_heading - int(row['HEADING'])))
-        return errors
+        return self.evaluate(data_path)["ABS_ERRORS"]
 
     def avg_absolute_error(self, data_path):
-        return float(np.mean(self.absolute_errors(data_path)))
+        return self.evaluate(data_path)["AVG_ABS_ERROR"]
 
     def directionally_correct(self, data_path):
-        threshold = 20
-        data = csv.DictReader(open(data_path))
-        correct_count, total_count = 0, 0
-        for row in data:
-            real_heading = self.get_ground_truth_heading(int(row['X_COOR']), int(row['Y_COOR']))
-            correct_count += int((real_heading - threshold) % self.vis_deg <= int(row['HEADING']) <= (real_heading + threshold) % self.vis_deg)
-            total_count += 1
-        return (correct_count/total_count)*100
+        return self.evaluate(data_path)["DIRECTIONALLY_CORRECT"]
 
     def locationally_correct(self, data_path):
-        threshold = 75
-        data = csv.DictReader(open(data_path))
-        correct_count, total_count = 0, 0
-        for row in data:
-            ground_truth_view_coor = self.get_ground_truth_coor(int(row['X_COOR']), int(row['Y_COOR']))
-            matched_route_view_coor = list(zip(self.route_X, self.route_Y))[int(row['MATCHED_ROUTE_VIEW_IDX'])]
-            correct_count += int((np.sqrt((np.square(ground_truth_view_coor[0] - matched_route_view_coor[0])) +
-                                          (np.square(ground_truth_view_coor[1] - matched_route_view_coor[1])))) <= threshold)
-
-            total_count += 1
-        return (correct_count/total_count)*100
+        return self.evaluate(data_path)["LOCATIONALLY_CORRECT"]
 
     def shift_colour_map(self, cmap, start=0, midpoint=0.5, stop=1.0, name='shiftedcmap'):
         cdict = {
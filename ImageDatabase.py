@@ -0,0 +1,103 @@
+import numpy as np
+import cv2
+from KeyedCache import KeyedCache
+import json
+import os
+
+# Single file container of the images of a grid or route database. Images are stored back to back, as their encoded
+# PNG bytes or as preprocessed uint8 arrays of one shape, followed by an index of each image's filename, (X, Y)
+# coordinate, offset and length, the index's length and MAGIC. The file is memory-mapped for random access, and runs of
+# consecutive images are read with a single read
+class ImageDatabase:
+    MAGIC = b"ANTIMGDB"
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as dbfile:
+            dbfile.seek(-len(self.MAGIC) - 8, os.SEEK_END)
+            index_length = int(np.frombuffer(dbfile.read(8), dtype='<u8')[0])
+            if dbfile.read(len(self.MAGIC)) != self.MAGIC:
+                raise ValueError(f"{path} is not an image database")
+            dbfile.seek(-len(self.MAGIC) - 8 - index_length, os.SEEK_END)
+            index = json.loads(dbfile.read(index_length).decode())
+        self.format = index['FORMAT']
+        self.shape = tuple(index['SHAPE']) if index['SHAPE'] is not None else None
+        self.filenames = index['FILENAMES']
+        self.offsets = np.array(index['OFFSETS'], dtype=np.int64)
+        self.lengths = np.array(index['LENGTHS'], dtype=np.int64)
+        self.filename_idxs = {filename: idx for idx, filename in enumerate(self.filenames)}
+        self.coor_idxs = {(x, y): idx for idx, (x, y) in enumerate(zip(index['X'], index['Y']))}
+        self.data = None
+
+    # The memory map is reopened lazily in worker processes rather than pickled
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
+
+    def __len__(self):
+        return len(self.filenames)
+
+    # Packs the images of filenames, read by read_image, with their coordinates. read_image returns encoded PNG bytes,
+    # or preprocessed uint8 arrays of one shape if preprocessed. Images are written chunk_size at a time
+    @staticmethod
+    def pack(path, filenames, coors, read_image, preprocessed=False, chunk_size=256):
+        offsets, lengths, shape = [], [], None
+        with KeyedCache.write_file(path) as tmp_path, open(tmp_path, 'wb') as dbfile:
+            for start in range(0, len(filenames), chunk_size):
+                chunk = []
+                for filename in filenames[start:start + chunk_size]:
+                    image = read_image(filename)
+                    if preprocessed:
+                        shape = image.shape
+                        image = np.ascontiguousarray(image, dtype=np.uint8).tobytes()
+                    offsets.append(dbfile.tell() + sum(len(data) for data in chunk))
+                    lengths.append(len(image))
+                    chunk.append(image)
+                dbfile.write(b"".join(chunk))
+            index = json.dumps({'FORMAT': 'RAW' if preprocessed else 'PNG', 'SHAPE': shape, 'FILENAMES': list(filenames),
+                                'X': [int(x) for x, _ in coors], 'Y': [int(y) for _, y in coors],
+                                'OFFSETS': offsets, 'LENGTHS': lengths}).encode()
+            dbfile.write(index)
+            dbfile.write(np.array([len(index)], dtype='<u8').tobytes())
+            dbfile.write(ImageDatabase.MAGIC)
+
+    def decode(self, data):
+        if self.format == 'RAW':
+            return np.array(data).reshape(self.shape)
+        return cv2.imdecode(np.asarray(data), cv2.IMREAD_COLOR)
+
+    # Image at an index, filename or (X, Y) coordinate, read through the memory map
+    def read(self, key):
+        if self.data is None:
+            self.data = np.memmap(self.path, dtype=np.uint8, mode='r')
+        idx = self.get_idx(key)
+        return self.decode(self.data[self.offsets[idx]:self.offsets[idx] + self.lengths[idx]])
+
+    def get_idx(self, key):
+        if isinstance(key, str):
+            return self.filename_idxs[key]
+        if isinstance(key, tuple):
+            return self.coor_idxs[key]
+        return key
+
+    # Images at a sequence of indexes, filenames or coordinates, reading each run of consecutive images at once
+    def read_many(self, keys):
+        idxs = np.array([self.get_idx(key) for key in keys], dtype=np.int64)
+        images = [None] * len(idxs)
+        order = np.argsort(idxs, kind='stable')
+        run_starts = np.flatnonzero(np.diff(idxs[order], prepend=-2) != 1)
+        with open(self.path, 'rb') as dbfile:
+            for run in np.split(order, run_starts[1:]):
+                first, last = idxs[run[0]], idxs[run[-1]]
+                dbfile.seek(self.offsets[first])
+                data = np.frombuffer(dbfile.read(self.offsets[last] + self.lengths[last] - self.offsets[first]), dtype=np.uint8)
+                for i in run:
+                    start = self.offsets[idxs[i]] - self.offsets[first]
+                    images[i] = self.decode(data[start:start + self.lengths[idxs[i]]])
+        return images
+
+    # Every image in storage order, chunk_size images per read
+    def iter_chunks(self, chunk_size=256):
+        for start in range(0, len(self), chunk_size):
+            yield self.read_many(range(start, min(start + chunk_size, len(self))))
@@ -0,0 +1,48 @@
+import contextlib
+import os
+
+# Files of a cache directory named {prefix}{key}{suffix}, key being a sha1 of whatever the cached contents are derived
+# from. Files are written under a temporary name ending in .tmp and moved into place, so no process reads a partly
+# written file, and the other files of the prefix are removed as stale once the new one is in place
+class KeyedCache:
+    def __init__(self, directory, prefix, suffix):
+        self.directory = directory
+        self.prefix = prefix
+        self.suffix = suffix
+
+    def get_path(self, key):
+        return f"{self.directory}{self.prefix}{key}{self.suffix}"
+
+    # Temporary path for the file of a key, moved to the key's path when the with block completes and followed by
+    # pruning the stale files of the prefix
+    @contextlib.contextmanager
+    def write(self, key):
+        path = self.get_path(key)
+        with self.write_file(path) as tmp_path:
+            yield tmp_path
+        self.prune(path)
+
+    # Temporary path for a file, moved to path when the with block completes and removed if it fails
+    @staticmethod
+    @contextlib.contextmanager
+    def write_file(path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            yield tmp_path
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+
+    # Removes the files of the prefix other than the one at path. Temporary files never end in the suffix, so files
+    # other processes are still writing are left alone
+    def prune(self, path):
+        for filename in os.listdir(self.directory):
+            if filename.startswith(self.prefix) and filename.endswith(self.suffix) and self.directory + filename != path:
+                try:
+                    os.remove(self.directory + filename)
+                except FileNotFoundError:
+                    pass
@@ -1,59 +1,180 @@
 from AnalysisToolkit import AnalysisToolkit
+from RFF import RFF
 import numpy as np
-import cv2
-from collections import defaultdict
 import matplotlib.pyplot as plt
 import os
 
 class PerfectMemory(AnalysisToolkit):
-    def __init__(self, route, vis_deg, rot_deg):
-        AnalysisToolkit.__init__(self, route, vis_deg, rot_deg)
+    def __init__(self, route, vis_deg, rot_deg, top_k=None, resolution=(45, 8)):
+        AnalysisToolkit.__init__(self, route, vis_deg, rot_deg, resolution)
         self.model_name = 'PERFECTMEMORY'
 
+        # Coarse-to-fine search: when top_k is set, route familiarity queries shortlist the top_k route views by a
+        # compact rotation invariant descriptor and only score those at full resolution
+        if top_k is not None and top_k < 1:
+            raise ValueError(f"top_k must be at least 1, not {top_k}")
+        self.top_k = top_k
+        self.load_memory()
+
+    # Route memory bank of the preprocessed views of every route, loaded once into one stack. Each route's memory is a
+    # slice of it, and memory_route_offsets holds the index of each route's first view in the stack
+    def load_memory(self):
+        route_views = []
+        for route_name in self.route_names:
+            with self.selected_route(route_name):
+                route_views.append(self.load_route_views())
+        self.memory_route_offsets = np.cumsum([0] + [len(views) for views in route_views])
+        self.memory_views = np.concatenate(route_views)
+        self.memory_spectra = self.get_spectra(self.memory_views)
+        self.memory_descriptors = self.get_descriptors(self.memory_spectra[0])
+
+        for route_name, start, end in zip(self.route_names, self.memory_route_offsets[:-1], self.memory_route_offsets[1:]):
+            with self.selected_route(route_name):
+                self.set_route_state(route_views=self.memory_views[start:end],
+                                     route_spectra=(self.memory_spectra[0][start:end], self.memory_spectra[1][start:end]),
+                                     route_descriptors=self.memory_descriptors[start:end])
+
+    # Reloads the route memory bank at the new resolution
+    def set_resolution(self, resolution):
+        AnalysisToolkit.set_resolution(self, resolution)
+        self.load_memory()
+
+    # Azimuthal spectra and energies of a stack of preprocessed views
+    def get_spectra(self, views):
+        views = np.asarray(views, dtype=float)
+        return np.fft.rfft(views, axis=-1), np.sum(views**2, axis=(-2, -1))
+
+    # Rotation invariant descriptors of a stack of views, the azimuthal spectrum magnitudes of each row
+    def get_descriptors(self, spectrum):
+        return np.abs(spectrum).reshape(len(spectrum), -1)
+
+    # Image differences of a preprocessed view, or a batch of them, at every rotation against a stack of views,
+    # (n_views, n_rotations) or (n_queries, n_views, n_rotations). Batches may also be scored against their own
+    # stacks of views, given spectra of shape (n_queries, n_views, ...)
+    def get_rIDF_matrix(self, view_preprocessed, spectra):
+        view_spectrum, view_energy = self.get_spectra(view_preprocessed)
+        views_spectrum, views_energy = spectra
+        height, width = view_preprocessed.shape[-2:]
+        # Circular cross-correlation along the azimuth axis for every column shift, summed over rows
+        cross_correlation = np.fft.irfft(np.einsum('...hf,...nhf->...nf', np.conj(view_spectrum), views_spectrum), n=width, axis=-1)
+        shifts = self.get_rotation_shifts(width, self.rotation_angles)
+        # Views hold integer pixel values, so rounding recovers the exact sum of squared differences
+        ssd = np.rint(np.expand_dims(view_energy, (-2, -1)) + views_energy[..., np.newaxis] - 2 * cross_correlation[..., shifts])
+        return ssd / float(height * width)
+
     # Rotational Image Difference Function for two views
     def get_view_rIDF(self, view_1, view_2, view_1_heading=0):
-        view_1_preprocessed = self.preprocess(view_1)
-        view_2_preprocessed = self.preprocess(view_2)
-        rIDF = {}
-        for i in np.arange(0, self.vis_deg, step=self.rot_deg, dtype=int):
-            view_1_rotated = self.rotate(view_1_preprocessed, i)
-            mse = np.sum(self.image_difference(view_1_rotated, view_2_preprocessed)**2)
-            mse /= float(view_1_preprocessed.shape[0] * view_1_preprocessed.shape[1])
-            rIDF[(i + view_1_heading) % self.vis_deg] = mse
-        return rIDF
-
-    # Rotational Image Difference Function for a view over a route representation
+        view_2_spectra = self.get_spectra(self.preprocess(view_2)[np.newaxis])
+        return RFF((self.rotation_angles + view_1_heading) % self.vis_deg,
+                   self.get_rIDF_matrix(self.preprocess(view_1), view_2_spectra)[0])
+
+    # Rotational Image Difference Function for a view over a route representation, one row per route view
     def get_route_rIDF(self, view, view_heading=0):
-        route_rIDF = defaultdict(list)
-        for idx, filename in enumerate(self.route_filenames):
-            route_view = cv2.imread(self.route_path + filename)
-            [route_rIDF[k].append(v) for k, v in self.get_view_rIDF(view, route_view, view_heading).items()]
-        return route_rIDF
+        return RFF((self.rotation_angles + view_heading) % self.vis_deg,
+                   self.get_rIDF_matrix(self.preprocess(view), self.route_spectra))
+
+    # Indexes of the top_k route views with descriptors closest to each of a batch of preprocessed views, in route order.
+    # route_descriptors defaults to the selected route's
+    def get_candidate_route_view_idxs(self, views_preprocessed, route_descriptors=None):
+        route_descriptors = self.route_descriptors if route_descriptors is None else route_descriptors
+        descriptors = self.get_descriptors(self.get_spectra(views_preprocessed)[0])
+        x = (np.sum(descriptors**2, axis=1)[:, np.newaxis] + np.sum(route_descriptors**2, axis=1) -
+             2 * descriptors @ route_descriptors.T)
+        return np.sort(np.argpartition(x, self.top_k - 1, axis=1)[:, :self.top_k], axis=1)
+
+    # Image differences of a batch of preprocessed views against the route views searched for each of them,
+    # (n_queries, n_searched_route_views, n_rotations), along with the searched route view indexes. The route spectra
+    # and descriptors default to the selected route's, and the whole memory bank's search every route together
+    def search_route(self, views_preprocessed, route_spectra=None, route_descriptors=None):
+        if route_spectra is None:
+            route_spectra, route_descriptors = self.route_spectra, self.route_descriptors
+        n_route_views = len(route_descriptors)
+        if self.top_k is None or self.top_k >= n_route_views:
+            route_view_idxs = np.broadcast_to(np.arange(n_route_views), (len(views_preprocessed), n_route_views))
+            return self.get_rIDF_matrix(views_preprocessed, route_spectra), route_view_idxs
+        route_view_idxs = self.get_candidate_route_view_idxs(views_preprocessed, route_descriptors)
+        candidate_spectra = (route_spectra[0][route_view_idxs], route_spectra[1][route_view_idxs])
+        return self.get_rIDF_matrix(views_preprocessed, candidate_spectra), route_view_idxs
 
     # Rotational Familiarity Function of a view against a route stored in perfect memory
     def get_route_rFF(self, view, view_heading=0):
-        return {k: -np.amin(v) for k, v in self.get_route_rIDF(view, view_heading).items()}
+        rFF = self.get_route_rFF_batch([view]).row(0)
+        return RFF((rFF.headings + view_heading) % self.vis_deg, rFF.scores)
+
+    # Rotational Familiarity Functions of a batch of views against the route, one row per view
+    def get_route_rFF_batch(self, views):
+        views_preprocessed = np.array([self.preprocess(view) for view in views])
+        return RFF(self.rotation_angles, -np.amin(self.search_route(views_preprocessed)[0], axis=1))
 
     # Rotational Familiarity Function of a view against another view
     def get_view_rFF(self, view_1, view_2, view_1_heading=0):
-        return {k: -v for k, v in self.get_view_rIDF(view_1, view_2, view_1_heading).items()}
+        return -self.get_view_rIDF(view_1, view_2, view_1_heading)
 
-    # Get the most familiar heading given an rFF for a view
+    # Get the most familiar heading given an rFF for a view, or for each row of a batch of rFFs
     def get_most_familiar_heading(self, rFF):
-        return max(rFF, key=rFF.get)
+        return rFF.argmax()
 
     # Calculates the signal strength of an rFF
     def get_signal_strength(self, rFF):
-        return max(rFF.values()) / np.array(list(rFF.values())).mean()
+        return rFF.signal_strength()
+
+    # rFF, most familiar heading and best matched route view index of a view, computed together
+    def query_route(self, view, route=None):
+        rFFs, familiar_headings, matched_route_view_idxs = self.query_route_batch([view], route)
+        return rFFs.row(0), familiar_headings[0], matched_route_view_idxs[0]
+
+    # rFFs, most familiar headings and best matched route view indexes of a batch of views from a single
+    # image difference matrix, the best match being the route view closest to each view at its familiar heading.
+    # A route name queries that route, leaving the selected route as it is
+    def query_route_batch(self, views, route=None):
+        with self.selected_route(route):
+            views_preprocessed = np.array([self.preprocess(view) for view in views])
+            route_rIDFs, route_view_idxs = self.search_route(views_preprocessed)
+            rFFs = RFF(self.rotation_angles, -np.amin(route_rIDFs, axis=1))
+            familiar_heading_idxs = np.argmax(rFFs.scores, axis=1)
+            matched_idxs = np.argmin(route_rIDFs[np.arange(len(views)), :, familiar_heading_idxs], axis=1)
+            return rFFs, self.rotation_angles[familiar_heading_idxs], route_view_idxs[np.arange(len(views)), matched_idxs]
+
+    # rFFs against the views of every route together, most familiar headings, and the routes and route view indexes of
+    # the best matches of a batch of views, from a single image difference matrix over the whole memory bank, or over
+    # the top_k views of the whole memory bank shortlisted for each view
+    def query_routes_batch(self, views):
+        views_preprocessed = np.array([self.preprocess(view) for view in views])
+        memory_rIDFs, memory_idxs = self.search_route(views_preprocessed, self.memory_spectra, self.memory_descriptors)
+        rFFs = RFF(self.rotation_angles, -np.amin(memory_rIDFs, axis=1))
+        familiar_heading_idxs = np.argmax(rFFs.scores, axis=1)
+        matched_idxs = memory_idxs[np.arange(len(views)),
+                                   np.argmin(memory_rIDFs[np.arange(len(views)), :, familiar_heading_idxs], axis=1)]
+        matched_route_idxs = np.searchsorted(self.memory_route_offsets, matched_idxs, side='right') - 1
+        return (rFFs, self.rotation_angles[familiar_heading_idxs], np.array(self.route_names)[matched_route_idxs],
+                matched_idxs - self.memory_route_offsets[matched_route_idxs])
+
+    # Fractions of a batch of views whose familiar heading and best matched route view from the coarse-to-fine search
+    # agree with an exhaustive search
+    def get_search_recall(self, views):
+        top_k = self.top_k
+        _, familiar_headings, matched_route_view_idxs = self.query_route_batch(views)
+        try:
+            self.top_k = None
+            _, exhaustive_familiar_headings, exhaustive_matched_route_view_idxs = self.query_route_batch(views)
+        finally:
+            self.top_k = top_k
+        return {"HEADING_RECALL": float(np.mean(familiar_headings == exhaustive_familiar_headings)),
+                "MATCH_RECALL": float(np.mean(matched_route_view_idxs == exhaustive_matched_route_view_idxs))}
 
     # get the index of the best matching route view to a view
     def get_matched_route_view_idx(self, view, view_heading=0):
-        # min_RIDF_idx = {k: (np.amin(v), np.argmin(v)) for k, v in self.get_route_rIDF(view, view_heading).items()}
-        # return min(min_RIDF_idx.values())[1]
         view_preprocessed = self.preprocess(self.rotate(view, view_heading))
-        x = {i: np.sum(self.image_difference(view_preprocessed, self.preprocess(cv2.imread(self.route_path+filename)))**2)
-             for i, filename in enumerate(self.route_filenames)}
-        return min(x, key=x.get)
+        x = np.sum(self.image_difference(view_preprocessed, self.route_views)**2, axis=(1, 2))
+        return int(np.argmin(x))
+
+    # get the indexes of the best matching route views to a batch of views
+    def get_matched_route_view_idx_batch(self, views, view_headings):
+        views_preprocessed = np.array([self.preprocess(view).astype(float).ravel()
+                                       for view in self.rotate_batch(views, view_headings)])
+        route_views = self.route_views.reshape(len(self.route_views), -1).astype(float)
+        x = np.sum(views_preprocessed**2, axis=1)[:, np.newaxis] + self.route_spectra[1] - 2 * views_preprocessed @ route_views.T
+        return np.argmin(x, axis=1)
 
 if __name__ == "__main__":
     route_name = "ant1_route1"
@@ -0,0 +1,61 @@
+import numpy as np
+
+# Rotational familiarity (or image difference) function backed by arrays: a heading axis shared by every row and
+# scores of shape (n_headings,) for a single view or (n_rows, n_headings) for a stack of views
+class RFF:
+    def __init__(self, headings, scores):
+        self.headings = np.asarray(headings)
+        self.scores = np.asarray(scores)
+
+    # Dict-style access over headings, for single view rFFs. A row of a stack of rFFs is taken with row first
+    def check_single(self):
+        if self.scores.ndim > 1:
+            raise ValueError(f"dict-style access needs a single view rFF, not a stack of {len(self.scores)}; use row(idx)")
+
+    def keys(self):
+        self.check_single()
+        return iter(self.headings)
+
+    def values(self):
+        self.check_single()
+        return iter(self.scores)
+
+    def items(self):
+        self.check_single()
+        return zip(self.headings, self.scores)
+
+    def get(self, heading):
+        self.check_single()
+        return self.scores[np.flatnonzero(self.headings == heading)[0]]
+
+    def __getitem__(self, heading):
+        return self.get(heading)
+
+    def __iter__(self):
+        return self.keys()
+
+    def __len__(self):
+        return len(self.headings)
+
+    def __neg__(self):
+        return RFF(self.headings, -self.scores)
+
+    def row(self, idx):
+        return RFF(self.headings, self.scores[idx])
+
+    # Heading of the first maximum of each row
+    def argmax(self):
+        return self.headings[np.argmax(self.scores, axis=-1)]
+
+    # Median of the headings whose scores are within prcnt percent of the row's maximum
+    def median_of_maxima(self, prcnt):
+        maxima = np.amax(self.scores, axis=-1, keepdims=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            is_maximum = np.where(maxima == 0, self.scores == 0, prcnt > np.abs(np.abs(maxima - self.scores) / maxima) * 100.0)
+        return np.nanmedian(np.where(is_maximum, self.headings, np.nan), axis=-1).astype(np.int64)
+
+    def signal_strength(self):
+        return np.amax(self.scores, axis=-1) / np.mean(self.scores, axis=-1)
+
+    def normalize(self, min, max=0):
+        return RFF(self.headings, (self.scores - min) / (max - min))